@@ -1,12 +1,16 @@
 # bot.py — Hydrate & Stretch Bot (pure slash edition)
 
+import io
 import os
 import random
 import logging
 import asyncio
+import heapq
 import itertools
+import time
+from dataclasses import dataclass
 from pathlib import Path
-from typing import Dict, Tuple, Optional, List
+from typing import Dict, Tuple, Optional, List, Set
 
 import discord
 from discord import app_commands
@@ -20,7 +24,8 @@ logging.basicConfig(
 )
 
 # ─────────── 1. Token / intents
-load_dotenv()
+if not os.environ.get("DISCORD_TOKEN"):  # deployed hosts usually set it; fall back to .env
+    load_dotenv()
 TOKEN = os.getenv("DISCORD_TOKEN")
 if not TOKEN:
     raise RuntimeError("Put DISCORD_TOKEN=… inside .env")
@@ -39,11 +44,34 @@ class HydrateBot(commands.Bot):
 bot = HydrateBot(command_prefix="!", intents=intents)
 
 # ─────────── 2. Globals & storage
-hydrate_tasks: Dict[int, Tuple[tasks.Loop, int]] = {}
-stretch_tasks: Dict[int, Tuple[tasks.Loop, int]] = {}
+@dataclass(slots=True)
+class Reminder:
+    kind: str
+    uid: int
+    channel_id: int  # resolved per send; channel objects are rebuilt on a fresh session
+    interval: float  # seconds
+    content: str  # rendered once at creation
+    images_dir: str
+    cancelled: bool = False
+    task: Optional[asyncio.Task] = None  # in-flight fire(), if any
+
+@dataclass(slots=True)
+class UserReminders:
+    hydrate: Optional[Reminder] = None
+    stretch: Optional[Reminder] = None
+
+REMINDERS: Dict[int, UserReminders] = {}
+SCHEDULE: List[Tuple[float, int, Reminder]] = []  # min-heap of (due, seq, reminder)
+_schedule_seq = itertools.count()  # tie-breaker so Reminders are never compared
+_fire_tasks: Set[asyncio.Task] = set()  # strong refs so in-flight sends aren't GC'd
 TASKS_LOCK = asyncio.Lock()
-PURGING = asyncio.Event()
-MEME_CACHE: Dict[str, List[str]] = {}
+PAUSED = asyncio.Event()  # set while the gateway is down; reminders hold until it clears
+PERMS_CACHE_TTL = 60  # seconds a resolved channel permission set is reused
+_PERMS_CACHE: Dict[int, Tuple[float, discord.Permissions]] = {}  # channel_id -> (expiry, perms)
+MEME_CACHE_TTL = 300  # seconds before a meme folder is rescanned
+MAX_MEME_BYTES = 8 * 1024 * 1024  # larger files are skipped, not held in RAM
+MEME_CACHE: Dict[str, Tuple[float, float, Tuple[str, ...]]] = {}  # folder -> (mtime, expiry, paths)
+MEME_BYTES: Dict[str, Tuple[float, int, bytes]] = {}  # path -> (st_mtime, st_size, data)
 
 status_list = [
     discord.Game("with water bottles 💧"),
@@ -53,111 +81,263 @@ status_list = [
 ]
 status_cycle = itertools.cycle(status_list)
 
-@tasks.loop(seconds=10)
+@tasks.loop(seconds=60)  # Discord asks for presence updates at most once a minute
 async def change_status():
+    if PAUSED.is_set() or not bot.is_ready() or bot.is_closed():
+        return
     await bot.change_presence(activity=next(status_cycle))
 
 @bot.event
 async def on_ready():
     print(f"Bot is online as {bot.user}")
+    _PERMS_CACHE.clear()  # a fresh session rebuilds every guild/channel object
+    PAUSED.clear()
     if not change_status.is_running():
         change_status.start()
+    if not run_schedule.is_running():
+        run_schedule.start()
 
 # ─────────── 3. Helpers
-def get_random_meme(folder: str) -> Optional[str]:
-    if folder not in MEME_CACHE:
-        path = Path(folder)
-        MEME_CACHE[folder] = [str(p) for p in path.iterdir() if p.is_file()] if path.is_dir() else []
-    files = MEME_CACHE[folder]
-    return random.choice(files) if files else None
-
-async def cancel_loop(loop: tasks.Loop) -> None:
-    if not loop.is_running():
-        return
-    loop.cancel()
-    task = getattr(loop, "task", None) or getattr(loop, "_task", None)
-    current = asyncio.current_task()
-    if isinstance(task, asyncio.Task) and not task.done() and task is not current:
-        try:
-            await task
-        except asyncio.CancelledError:
-            pass
+def _scan_memes(folder: str) -> Tuple[str, ...]:
+    # DirEntry.is_file() uses the dirent type, so a rescan is one directory read, no per-file stat
+    try:
+        with os.scandir(folder) as it:
+            return tuple(entry.path for entry in it if entry.is_file(follow_symlinks=False))
+    except (FileNotFoundError, NotADirectoryError):
+        return ()
 
-async def purge_all_reminders(reason: str) -> None:
-    if PURGING.is_set():
+def _meme_files(folder: str) -> Tuple[str, ...]:
+    # stat is far cheaper than a listing, so only rescan on mtime change or TTL expiry
+    try:
+        mtime = os.stat(folder).st_mtime
+    except (FileNotFoundError, NotADirectoryError):
+        mtime = 0.0
+    now = time.monotonic()
+    cached = MEME_CACHE.get(folder)
+    if cached is not None and cached[0] == mtime and now <= cached[1]:
+        return cached[2]
+    files = _scan_memes(folder)
+    if cached is not None:
+        for gone in set(cached[2]).difference(files):
+            MEME_BYTES.pop(gone, None)
+    MEME_CACHE[folder] = (mtime, now + MEME_CACHE_TTL, files)
+    return files
+
+def _meme_bytes(path: str) -> Optional[bytes]:
+    # read lazily so a huge folder is never loaded wholesale; the stat catches in-place
+    # overwrites and half-copied files, and failures are not cached so they get retried
+    try:
+        st = os.stat(path)
+    except OSError as e:
+        logging.warning("Could not stat %s: %s", path, e)
+        MEME_BYTES.pop(path, None)
+        return None
+    cached = MEME_BYTES.get(path)
+    if cached is not None and cached[0] == st.st_mtime and cached[1] == st.st_size:
+        return cached[2]
+    MEME_BYTES.pop(path, None)
+    if st.st_size > MAX_MEME_BYTES:
+        logging.warning("Skipping %s – larger than %d bytes", path, MAX_MEME_BYTES)
+        return None
+    try:
+        data = Path(path).read_bytes()
+    except OSError as e:
+        logging.warning("Could not read %s: %s", path, e)
+        return None
+    MEME_BYTES[path] = (st.st_mtime, st.st_size, data)
+    return data
+
+def get_random_meme(folder: str) -> Optional[Tuple[str, bytes]]:
+    files = _meme_files(folder)
+    if not files:
+        return None
+    path = files[random.randrange(len(files))]
+    data = _meme_bytes(path)
+    return (path, data) if data is not None else None
+
+def cached_perms(channel: discord.TextChannel) -> discord.Permissions:
+    now = time.monotonic()
+    cached = _PERMS_CACHE.get(channel.id)
+    if cached is not None and now <= cached[0]:
+        return cached[1]
+    perms = channel.permissions_for(channel.guild.me)
+    _PERMS_CACHE[channel.id] = (now + PERMS_CACHE_TTL, perms)
+    return perms
+
+def forget_guild_perms(guild: discord.Guild) -> None:
+    for ch in guild.channels:
+        _PERMS_CACHE.pop(ch.id, None)
+
+async def cancel_reminder(r: Reminder) -> None:
+    # lazy delete: the scheduler skips cancelled entries when they come due
+    r.cancelled = True
+    task = r.task
+    if task is None or task.done() or task is asyncio.current_task():
         return
-    PURGING.set()
-    logging.warning("Purging all reminders – %s", reason)
+    task.cancel()
     try:
-        async with TASKS_LOCK:
-            for uid, (loop, _) in list(hydrate_tasks.items()):
-                await cancel_loop(loop)
-                hydrate_tasks.pop(uid, None)
-            for uid, (loop, _) in list(stretch_tasks.items()):
-                await cancel_loop(loop)
-                stretch_tasks.pop(uid, None)
-    finally:
-        PURGING.clear()
-
-def make_reminder_loop(
-    kind: str,
-    minutes: int,
-    channel: discord.TextChannel,
-    mention: str,
-    store: Dict[int, Tuple[tasks.Loop, int]],
-    uid: int
-) -> tasks.Loop:
+        await task
+    except asyncio.CancelledError:
+        pass
+
+def pop_reminder(uid: int, kind: str) -> Optional[Reminder]:
+    # caller holds TASKS_LOCK; drops the user entry once both kinds are gone
+    entry = REMINDERS.get(uid)
+    if entry is None:
+        return None
+    r = getattr(entry, kind)
+    setattr(entry, kind, None)
+    if entry.hydrate is None and entry.stretch is None:
+        del REMINDERS[uid]
+    return r
+
+async def drop_reminder(r: Reminder) -> None:
+    r.cancelled = True
+    async with TASKS_LOCK:
+        entry = REMINDERS.get(r.uid)
+        if entry is not None and getattr(entry, r.kind) is r:
+            pop_reminder(r.uid, r.kind)
+
+async def drop_channel_reminders(channel_ids: Set[int]) -> None:
+    async with TASKS_LOCK:
+        doomed = [
+            r for entry in REMINDERS.values() for r in (entry.hydrate, entry.stretch)
+            if r and r.channel_id in channel_ids
+        ]
+        for r in doomed:
+            r.cancelled = True
+            pop_reminder(r.uid, r.kind)
+    for cid in channel_ids:
+        _PERMS_CACHE.pop(cid, None)
+
+def make_reminder(kind: str, minutes: int, channel: discord.TextChannel, mention: str, uid: int) -> Reminder:
     emoji = "💧" if kind == "hydrate" else "🤸"
-    images_dir = "memes" if kind == "hydrate" else "stretch"
-
-    async def tick():
-        perms = channel.permissions_for(channel.guild.me)
-        if not perms.send_messages:
-            logging.warning("Lost send permission in %s – stopping loop", channel)
-            loop.stop()
-            async with TASKS_LOCK:
-                store.pop(uid, None)
-            return
-
-        meme = get_random_meme(images_dir)
-        content = f"{emoji} Time to {kind}, {mention}!"
-        try:
-            if meme and perms.attach_files:
-                await channel.send(content, file=discord.File(meme))
-            else:
-                await channel.send(content)
-        except discord.Forbidden:
-            logging.warning("Forbidden in %s – stopping loop", channel)
-            loop.stop()
-            async with TASKS_LOCK:
-                store.pop(uid, None)
-
-    loop = tasks.loop(minutes=minutes)(tick)
-    return loop
+    return Reminder(
+        kind=kind,
+        uid=uid,
+        channel_id=channel.id,
+        interval=minutes * 60,
+        content=f"{emoji} Time to {kind}, {mention}!",
+        images_dir="memes" if kind == "hydrate" else "stretch",
+    )
+
+def schedule_reminder(r: Reminder, due: float) -> None:
+    heapq.heappush(SCHEDULE, (due, next(_schedule_seq), r))
+
+async def fire(r: Reminder) -> None:
+    channel = bot.get_channel(r.channel_id)
+    if channel is None:
+        # often just not cached yet (guild still loading after a fresh session, archived
+        # thread); real deletions are handled by NotFound and the delete listeners
+        logging.debug("Channel %d not in cache – skipping this reminder", r.channel_id)
+        return
+    perms = cached_perms(channel)
+    if not perms.send_messages:
+        logging.warning("Lost send permission in %s – stopping reminder", channel)
+        await drop_reminder(r)
+        return
+
+    # content + in-memory file go out as one multipart request; nothing touches disk here
+    meme = get_random_meme(r.images_dir) if perms.attach_files else None
+    try:
+        if meme:
+            path, data = meme
+            try:
+                await channel.send(r.content, file=discord.File(io.BytesIO(data), filename=os.path.basename(path)))
+            except discord.Forbidden:
+                # cached attach_files may be stale; fall back to text before giving up
+                _PERMS_CACHE.pop(channel.id, None)
+                await channel.send(r.content)
+        else:
+            await channel.send(r.content)
+    except (discord.Forbidden, discord.NotFound) as e:
+        # Forbidden: access revoked; NotFound: channel deleted – neither recovers by retrying
+        logging.warning("%s in %s – stopping reminder", type(e).__name__, channel)
+        _PERMS_CACHE.pop(channel.id, None)
+        await drop_reminder(r)
+
+def _fire_done(task: asyncio.Task) -> None:
+    _fire_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logging.error("Reminder send failed", exc_info=task.exception())
+
+@tasks.loop(seconds=1)
+async def run_schedule():
+    # one loop drives every user's reminders instead of a tasks.Loop per user
+    if PAUSED.is_set():
+        return
+    now = time.monotonic()
+    while SCHEDULE and SCHEDULE[0][0] <= now:
+        due, _, r = heapq.heappop(SCHEDULE)
+        if r.cancelled:
+            continue
+        # a send still stuck from the previous interval covers this one too
+        if r.task is None or r.task.done():
+            r.task = asyncio.create_task(fire(r))
+            _fire_tasks.add(r.task)
+            r.task.add_done_callback(_fire_done)
+        next_due = due + r.interval
+        schedule_reminder(r, next_due if next_due > now else now + r.interval)
 
 # ─────────── 4. Events
 @bot.event
 async def on_disconnect():
-    await purge_all_reminders("gateway disconnect")
+    logging.warning("Gateway disconnected – pausing reminders.")
+    PAUSED.set()
 
 @bot.event
 async def on_resumed():
     logging.info("Gateway resumed.")
+    PAUSED.clear()
+
+@bot.event
+async def on_guild_role_create(role: discord.Role):
+    forget_guild_perms(role.guild)
+
+@bot.event
+async def on_guild_role_delete(role: discord.Role):
+    forget_guild_perms(role.guild)
+
+@bot.event
+async def on_guild_role_update(before: discord.Role, after: discord.Role):
+    forget_guild_perms(after.guild)
+
+@bot.event
+async def on_guild_channel_delete(channel: discord.abc.GuildChannel):
+    await drop_channel_reminders({channel.id})
+
+@bot.event
+async def on_thread_delete(thread: discord.Thread):
+    await drop_channel_reminders({thread.id})
+
+@bot.event
+async def on_guild_remove(guild: discord.Guild):
+    await drop_channel_reminders({ch.id for ch in guild.channels} | {t.id for t in guild.threads})
+
+@bot.event
+async def on_guild_channel_update(before: discord.abc.GuildChannel, after: discord.abc.GuildChannel):
+    _PERMS_CACHE.pop(after.id, None)
+
+@bot.event
+async def on_member_update(before: discord.Member, after: discord.Member):
+    if bot.user and after.id == bot.user.id:
+        forget_guild_perms(after.guild)
 
 # ─────────── 5. Slash commands
+HELP_EMBED = discord.Embed(
+    title="Hydrate & Stretch Bot",
+    colour=0x00B2FF,
+    description="All reminders are per-user – only *you* are pinged.",
+)
+HELP_EMBED.add_field(name="/hydrate <minutes> [channel]", value="Start hydration reminders.", inline=False)
+HELP_EMBED.add_field(name="/stretch <minutes> [channel]", value="Start stretch reminders.", inline=False)
+HELP_EMBED.add_field(name="/stophydrate /stopstretch", value="Stop a reminder.", inline=False)
+HELP_EMBED.add_field(name="/stopreminders", value="Stop **all** your reminders.", inline=False)
+HELP_EMBED.set_footer(text="Slash only — no !commands here.")
+
 @bot.tree.command(name="help", description="Show instructions.")
 async def help_cmd(interaction: discord.Interaction):
-    embed = discord.Embed(
-        title="Hydrate & Stretch Bot",
-        colour=0x00B2FF,
-        description="All reminders are per-user – only *you* are pinged.",
-    )
-    embed.add_field(name="/hydrate <minutes> [channel]", value="Start hydration reminders.", inline=False)
-    embed.add_field(name="/stretch <minutes> [channel]", value="Start stretch reminders.", inline=False)
-    embed.add_field(name="/stophydrate /stopstretch", value="Stop a reminder.", inline=False)
-    embed.add_field(name="/stopreminders", value="Stop **all** your reminders.", inline=False)
-    embed.set_footer(text="Slash only — no !commands here.")
-    await interaction.response.send_message(embed=embed, ephemeral=True)
+    await interaction.response.send_message(embed=HELP_EMBED, ephemeral=True)
 
 @bot.tree.command(name="hydrate", description="Start a hydration reminder.")
 @app_commands.describe(
@@ -167,30 +347,29 @@ async def help_cmd(interaction: discord.Interaction):
 async def hydrate(interaction: discord.Interaction, minutes: int, channel: Optional[discord.TextChannel] = None):
     if not 1 <= minutes <= 1440:
         return await interaction.response.send_message("⛔ Minutes must be 1-1440.", ephemeral=True)
-    if PURGING.is_set():
-        return await interaction.response.send_message("⏳ Bot is reconnecting.", ephemeral=True)
 
     channel = channel or interaction.channel
     if not channel.permissions_for(channel.guild.me).send_messages:
         return await interaction.response.send_message("❌ I can't send messages there.", ephemeral=True)
 
+    r = make_reminder("hydrate", minutes, channel, interaction.user.mention, interaction.user.id)
     async with TASKS_LOCK:
-        if interaction.user.id in hydrate_tasks:
-            return await interaction.response.send_message("💧 You already have a hydration reminder (use /stophydrate).", ephemeral=True)
-        loop = make_reminder_loop("hydrate", minutes, channel, interaction.user.mention, hydrate_tasks, interaction.user.id)
-        loop.start()
-        hydrate_tasks[interaction.user.id] = (loop, channel.id)
+        entry = REMINDERS.setdefault(interaction.user.id, UserReminders())
+        running = entry.hydrate is not None
+        if not running:
+            entry.hydrate = r
+    if running:
+        return await interaction.response.send_message("💧 You already have a hydration reminder (use /stophydrate).", ephemeral=True)
+    schedule_reminder(r, time.monotonic())
     await interaction.response.send_message(f"💧 Hydration reminder every {minutes} min in {channel.mention}", ephemeral=True)
 
 @bot.tree.command(name="stophydrate", description="Stop hydration reminder.")
 async def stophydrate(interaction: discord.Interaction):
-    if PURGING.is_set():
-        return await interaction.response.send_message("⏳ Bot is reconnecting.", ephemeral=True)
     async with TASKS_LOCK:
-        tup = hydrate_tasks.pop(interaction.user.id, None)
-        if not tup:
-            return await interaction.response.send_message("⚠️ No active hydration reminder.", ephemeral=True)
-        await cancel_loop(tup[0])
+        r = pop_reminder(interaction.user.id, "hydrate")
+    if not r:
+        return await interaction.response.send_message("⚠️ No active hydration reminder.", ephemeral=True)
+    await cancel_reminder(r)
     await interaction.response.send_message("🛑 Hydration reminder stopped.", ephemeral=True)
 
 @bot.tree.command(name="stretch", description="Start a stretch reminder.")
@@ -201,46 +380,45 @@ async def stophydrate(interaction: discord.Interaction):
 async def stretch(interaction: discord.Interaction, minutes: int, channel: Optional[discord.TextChannel] = None):
     if not 1 <= minutes <= 1440:
         return await interaction.response.send_message("⛔ Minutes must be 1-1440.", ephemeral=True)
-    if PURGING.is_set():
-        return await interaction.response.send_message("⏳ Bot is reconnecting.", ephemeral=True)
 
     channel = channel or interaction.channel
     if not channel.permissions_for(channel.guild.me).send_messages:
         return await interaction.response.send_message("❌ I can't send messages there.", ephemeral=True)
 
+    r = make_reminder("stretch", minutes, channel, interaction.user.mention, interaction.user.id)
     async with TASKS_LOCK:
-        if interaction.user.id in stretch_tasks:
-            return await interaction.response.send_message("🤸 You already have a stretch reminder (use /stopstretch).", ephemeral=True)
-        loop = make_reminder_loop("stretch", minutes, channel, interaction.user.mention, stretch_tasks, interaction.user.id)
-        loop.start()
-        stretch_tasks[interaction.user.id] = (loop, channel.id)
+        entry = REMINDERS.setdefault(interaction.user.id, UserReminders())
+        running = entry.stretch is not None
+        if not running:
+            entry.stretch = r
+    if running:
+        return await interaction.response.send_message("🤸 You already have a stretch reminder (use /stopstretch).", ephemeral=True)
+    schedule_reminder(r, time.monotonic())
     await interaction.response.send_message(f"🤸 Stretch reminder every {minutes} min in {channel.mention}", ephemeral=True)
 
 @bot.tree.command(name="stopstretch", description="Stop stretch reminder.")
 async def stopstretch(interaction: discord.Interaction):
-    if PURGING.is_set():
-        return await interaction.response.send_message("⏳ Bot is reconnecting.", ephemeral=True)
     async with TASKS_LOCK:
-        tup = stretch_tasks.pop(interaction.user.id, None)
-        if not tup:
-            return await interaction.response.send_message("⚠️ No active stretch reminder.", ephemeral=True)
-        await cancel_loop(tup[0])
+        r = pop_reminder(interaction.user.id, "stretch")
+    if not r:
+        return await interaction.response.send_message("⚠️ No active stretch reminder.", ephemeral=True)
+    await cancel_reminder(r)
     await interaction.response.send_message("🛑 Stretch reminder stopped.", ephemeral=True)
 
 @bot.tree.command(name="stopreminders", description="Stop all your reminders.")
 async def stopreminders(interaction: discord.Interaction):
-    if PURGING.is_set():
-        return await interaction.response.send_message("⏳ Bot is reconnecting.", ephemeral=True)
     stopped = []
     async with TASKS_LOCK:
-        tup = hydrate_tasks.pop(interaction.user.id, None)
-        if tup:
-            await cancel_loop(tup[0])
-            stopped.append("💧 Hydration")
-        tup = stretch_tasks.pop(interaction.user.id, None)
-        if tup:
-            await cancel_loop(tup[0])
-            stopped.append("🤸 Stretch")
+        entry = REMINDERS.pop(interaction.user.id, None)
+    if entry:
+        # cancel both in-flight sends together rather than one after the other
+        async with asyncio.TaskGroup() as tg:
+            if entry.hydrate:
+                tg.create_task(cancel_reminder(entry.hydrate))
+                stopped.append("💧 Hydration")
+            if entry.stretch:
+                tg.create_task(cancel_reminder(entry.stretch))
+                stopped.append("🤸 Stretch")
 
     if stopped:
         await interaction.response.send_message(f"🛑 Stopped: {', '.join(stopped)} reminders.", ephemeral=True)